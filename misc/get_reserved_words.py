@@ -3,6 +3,12 @@
 import yaml
 import json
 
+try:
+    # much faster if PyYAML was built with libyaml
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 registers = ["$zero", "$at", "$gp", "$sp", "$fp", "$ra"]
 registers += [f"$v{n}" for n in range(2)]
 registers += [f"$a{n}" for n in range(4)]
@@ -17,7 +23,7 @@ directives = [
 
 with open("mips.yaml") as stream:
     try:
-        mips = yaml.safe_load(stream)
+        mips = yaml.load(stream, Loader=SafeLoader)
     except yaml.YAMLError as exc:
         print(exc)
 
@@ -19,7 +19,15 @@ from .macro import Preprocessor, PreprocessingException
 from sys import stderr, exit
 from time import sleep
 
+try:
+    # optional (Linux only), lets --watch wait for changes instead of polling for them
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 WATCH_POLL_DELAY = 0.5  # check 2x per second
+# with inotify, still check the mtime this often in case events never arrive (e.g. on NFS)
+WATCH_BACKSTOP_DELAY = 2
 
 
 def main(source_file, out_file, should_print, clobber, err_keep_going, should_watch):
@@ -44,7 +52,7 @@ def main(source_file, out_file, should_print, clobber, err_keep_going, should_wa
     # do the preprocessing
     preprocessor = Preprocessor(err_keep_going)
     if should_watch:
-        # poll the input file and reprocess if it has been changed
+        # wait for the input file to change and reprocess it
         preprocess_watch(preprocessor, source_path, out_path)
     else:
         preprocess_once(preprocessor, source_path, out_path)
@@ -55,34 +63,70 @@ def write_output(out_path, output):
         # output to stdout
         print(output)
     else:
-        out_path.write_text(output)
+        # same encoding as the source is read with (see read_prog)
+        out_path.write_text(output, encoding="utf-8")
 
 
 def preprocess_watch(preprocessor, source_path, out_path):
+    if INotify is not None:
+        # watch the directory rather than the file so saves that replace the file are seen too.
+        # resolve first so that if the source is a symlink we watch where the real file is.
+        watched_path = source_path.resolve()
+        inotify = INotify()
+        inotify.add_watch(watched_path.parent, flags.CLOSE_WRITE | flags.MOVED_TO)
+    else:
+        inotify = None
+
+    prev_prog = None
     while True:
-        prev_mtime = source_path.stat().st_mtime
+        if inotify is None:
+            prev_mtime = source_path.stat().st_mtime
 
         prog = read_prog(source_path)
-        try:
-            output = preprocessor.process(prog)
-            write_output(out_path, output)
-            stderr.write("[ Preprocessing succeeded ]\n")
-        except PreprocessingException:
-            # we don't want to exit, just report the errors
-            stderr.write("[ Preprocessing failed, no output was generated ]\n")  
-
-        # periodically check to see if the file has changed
+        if prog == prev_prog:
+            # e.g. saved without any changes, the output would be the same
+            stderr.write("[ Source file contents unchanged, skipping ]\n")
+        else:
+            prev_prog = prog
+            try:
+                output = preprocessor.process(prog)
+                write_output(out_path, output)
+                stderr.write("[ Preprocessing succeeded ]\n")
+            except PreprocessingException:
+                # we don't want to exit, just report the errors
+                stderr.write("[ Preprocessing failed, no output was generated ]\n")  
+
+        # wait for the file to change
         stderr.write("\n[ Watching for Changes... ]\n")
         stderr.flush()
         try:
-            while source_path.stat().st_mtime == prev_mtime:
-                sleep(WATCH_POLL_DELAY)
+            if inotify is not None:
+                wait_for_event(inotify, watched_path)
+            else:
+                wait_for_mtime_change(source_path, prev_mtime)
         except KeyboardInterrupt:
             stderr.write("[ Got ctrl-c, exiting ]\n")
             exit(0)
         stderr.write("[ Source file change detected ]\n")
 
 
+def wait_for_event(inotify, watched_path):
+    # inotify only sees changes made through this machine's kernel, so on some filesystems
+    # (network mounts, WSL's /mnt/c, etc.) there may never be an event; fall back to the mtime
+    prev_mtime = watched_path.stat().st_mtime
+    while True:
+        events = inotify.read(timeout=WATCH_BACKSTOP_DELAY * 1000)
+        if any(event.name == watched_path.name for event in events):
+            return
+        if watched_path.stat().st_mtime != prev_mtime:
+            return
+
+
+def wait_for_mtime_change(source_path, prev_mtime):
+    while source_path.stat().st_mtime == prev_mtime:
+        sleep(WATCH_POLL_DELAY)
+
+
 def preprocess_once(preprocessor, source_path, out_path):
     prog = read_prog(source_path)
     try:
@@ -95,10 +139,17 @@ def preprocess_once(preprocessor, source_path, out_path):
 
 def read_prog(source_path):
     try:
-        return source_path.read_text()
+        prog = source_path.read_bytes().decode("utf-8")
     except FileNotFoundError:
         stderr.write(f"ERROR - Source file {source_path} does not exist.\n")
         exit(1)
+    except UnicodeDecodeError as e:
+        stderr.write(f"ERROR - Source file {source_path} is not valid UTF-8 ({e.reason}).\n")
+        exit(1)
+    # normalise newlines the same way read_text() would (only if there are any to normalise)
+    if "\r" in prog:
+        prog = prog.replace("\r\n", "\n").replace("\r", "\n")
+    return prog
 
 
 def cli():
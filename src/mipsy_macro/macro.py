@@ -45,31 +45,39 @@
 # TODO: editor support (hopefully won't be too hard)
 # TODO: tidy up the code
 
-from enum import Enum, auto
 from logging import CRITICAL, WARNING, ERROR, getLogger, StreamHandler, Formatter
 import re
 import json
+from bisect import bisect_left
 from collections import defaultdict
 from pathlib import Path
 
-# State machine states for tokenisation
-class State(Enum):
-    CODE = auto()        # anything that's not a string/char/comment
-    STRING = auto()      # inside a string literal
-    STRING_ESC = auto()  # the character escaped by a backslash in a string
-    CHAR = auto()        # first internal character of a single-quoted char literal
-    CHAR_2 = auto()      # second character in a single-quoted char literal
-    CHAR_END = auto()    # closing quote of single-quoted char literal
-    COMMENT = auto()     # characters between the # and \n in a comment
-
-# regexr.com/86aoc
-#                        match non-label tokens   match labels
-TOKEN_RE = re.compile(r"(^[$.@!]?[A-Za-z_]\w*\Z)|(^[A-Za-z_][\w.]*:\Z)")
-# allows starting with a number because we don't want to let numbers separate tokens
-PSEUDO_TOKEN_RE = re.compile(r"(^[$.@!]?\w*\Z)|(^\w[\w.]*:\Z)")
+# Single-pass tokeniser. The groups are tried in order at each position:
+#   str    - a double-quoted string (may span lines, may be unterminated at EOF)
+#   chr    - a single-quoted char literal; if it isn't closed, `badchr` captures the offending
+#            character and the rest of its line, which gets ignored
+#   cmt    - a comment (or #define) up to the end of the line
+#   tok    - a token that might be substituted, or a label definition
+#   word   - anything else made of word characters, e.g. numbers (these still separate tokens,
+#            we don't want the "abc" in "1abc" to be a token)
+#   other  - everything else (punctuation, whitespace, newlines)
+# None of the groups backtrack more than a couple of characters, so the scan stays linear
+# even on unterminated strings (str is written as an "unrolled loop" so that
+# runs of plain characters are consumed in one step rather than one alternation per character).
+SCANNER_RE = re.compile(
+    r"""(?P<str>"[^"\\]*(?:\\.[^"\\]*)*"?)"""
+    r"""|(?P<chr>'(?:\\.|.)(?:'|(?P<badchr>\n|[^'\n][^\n]*\n?))?|')"""
+    r"""|(?P<cmt>\#[^\n]*)"""
+    r"""|(?P<tok>[A-Za-z_]\w*:?|[$.@!][A-Za-z_]\w*)"""
+    r"""|(?P<word>\w+:?|[$.@!]\w*)"""
+    r"""|(?P<other>[^\w$.@!"'\#]+)""",
+    re.S
+)
 MACRO_NAME_RE = re.compile(r"^[$.@!]?[A-Za-z_]\w*\Z")
 # crude literal number matching
 NUMBER_RE = re.compile(r"^-?(0(x|o|b))?[\da-fA-F]+\Z")
+# numbered registers $0 to $31
+REG_NUM_RE = re.compile(r"^\$0*([0-9]|[12][0-9]|3[01])\Z")
 LABEL_RE = re.compile(r"^[A-Za-z_][\w.]*\Z")
 # number/label/char
 IMMEDIATE_RE = re.compile(r"^((-?(0(x|o|b))?[\da-fA-F]+)|([A-Za-z_][\w.]*)|('\\?.'))\Z")
@@ -80,11 +88,10 @@ DETECT_COMMENT_OR_STR_RE = re.compile(r"(?<!')(#|\")")
 reserved_words_path = Path(__file__).parent / "./resources/reserved_words.json"
 with open(reserved_words_path, "r") as f:
     reserved_word_lists = json.load(f)
-    reserved_words = set([
-        *reserved_word_lists["registers"],
-        *reserved_word_lists["instructions"],
-        *reserved_word_lists["directives"]
-    ])
+REGISTERS = frozenset(reserved_word_lists["registers"])
+DIRECTIVES = frozenset(reserved_word_lists["directives"])
+INSTRUCTIONS = frozenset(reserved_word_lists["instructions"])
+reserved_words = REGISTERS | DIRECTIVES | INSTRUCTIONS
 # the base token of the reserved words, e.g. $sp --> sp
 reserved_words_stripped = {word.lstrip("$."): word for word in reserved_words}
 
@@ -116,16 +123,18 @@ class Preprocessor:
     # Modifies a logged message to add the line number that processing is at
     # Used as a filter in the logger (but doesn't do any filtering)
     def _add_line_no(self, record):
-        record.msg = f"Line {self.line_no}: {record.msg}"
+        # the line number is the number of newlines before the current position (+1)
+        line_no = bisect_left(self._newlines, self._pos) + 1
+        record.msg = f"Line {line_no}: {record.msg}"
         return True
 
 
-    # Logs `message` at log level `level` iff `value` is falsy, raising an exception if required
-    def _log_assert(self, value, message, level=CRITICAL):
-        if not value:
-            self.logger.log(level, message)
-            if level >= CRITICAL or (level >= ERROR and not self.err_keep_going):
-                raise PreprocessingException(message)
+    # Logs `message` at log level `level` for a failed check, raising an exception if required.
+    # Only called once a check has failed so that messages aren't formatted unless they're needed.
+    def _fail(self, message, level=CRITICAL):
+        self.logger.log(level, message)
+        if level >= CRITICAL or (level >= ERROR and not self.err_keep_going):
+            raise PreprocessingException(message)
 
 
     def name_type(self, name):
@@ -138,11 +147,7 @@ class Preprocessor:
         
 
     def is_register(self, value: str):
-        if value in reserved_word_lists["registers"]:
-            return True
-        if value[1:].isnumeric() and int(value[1:]) < 32:
-            return True
-        return False
+        return value in REGISTERS or bool(REG_NUM_RE.match(value))
     
 
     def strip_name(self, name: str):
@@ -152,42 +157,45 @@ class Preprocessor:
     # Perform a bunch of checks on the macro name and value.
     # Doesn't strictly parse the value but instead uses heuristics/crude parsing because it's
     # easier to give meaningful error messages this way (and parsing is complex and fragile).
-    def check_macro(self, name: str, value: str):
+    # Returns the stripped name (see strip_name) so that the caller doesn't have to recompute it.
+    def check_macro(self, name: str, value: str) -> str:
         # Check that the name uses legal characters
-        self._log_assert(
-            MACRO_NAME_RE.match(name),
-            f"Macro name '{name}' is not valid. Macro names must have this format:\n" +
-            "  <$ or @ or ! or . or nothing><letter or _><0 or more letters, numbers, and/or _>\n" +
-            "  e.g. $NAME e.g. NAME_1 e.g. _123ABC e.g. @BIG_ARRAY",
-            ERROR
-        )
+        if not MACRO_NAME_RE.match(name):
+            self._fail(
+                f"Macro name '{name}' is not valid. Macro names must have this format:\n" +
+                "  <$ or @ or ! or . or nothing><letter or _>" +
+                "<0 or more letters, numbers, and/or _>\n" +
+                "  e.g. $NAME e.g. NAME_1 e.g. _123ABC e.g. @BIG_ARRAY",
+                ERROR
+            )
 
         # Check that the name is uppercase and doesn't conflict
-        self._log_assert(
-            not any(c.islower() for c in name),
-            f"Macro name '{name}' is not uppercase. All caps macro names are encouraged.",
-            WARNING
-        )
-
-        self._log_assert(
-            name.lower() not in reserved_words,
-            f"Macro name '{name}' conflicts with a MIPS {self.name_type(name)} name.",
-            ERROR
-        )
-
-        self._log_assert(
-            name not in self.macros,
-            f"A macro with name '{name}' is already defined. Redefinition of macros is not allowed.",
-            ERROR
-        )
+        if name.upper() != name:
+            self._fail(
+                f"Macro name '{name}' is not uppercase. All caps macro names are encouraged.",
+                WARNING
+            )
+
+        if name.lower() in reserved_words:
+            self._fail(
+                f"Macro name '{name}' conflicts with a MIPS {self.name_type(name)} name.",
+                ERROR
+            )
+
+        if name in self.macros:
+            self._fail(
+                f"A macro with name '{name}' is already defined. " +
+                "Redefinition of macros is not allowed.",
+                ERROR
+            )
 
         # Check for similarity (equality w/o case and prefix) to other symbols
         name_stripped = self.strip_name(name)
-        if name_stripped in reserved_words_stripped:
+        similar_word = reserved_words_stripped.get(name_stripped)
+        if similar_word is not None:
             self.logger.warning(
                 f"Macro name '{name}' is similar to the MIPS " +
-                f"{self.name_type(reserved_words_stripped[name_stripped])} " +
-                f"'{reserved_words_stripped[name_stripped]}'."
+                f"{self.name_type(similar_word)} '{similar_word}'."
             )
         if name_stripped in self.macros_stripped:
             self.logger.warning(
@@ -195,69 +203,73 @@ class Preprocessor:
                 f"{self.macros_stripped[name_stripped]}."
             )
 
-        self._log_assert(
-            name not in self.labels,
-            f"Macro name '{name}' conflicts with an existing label.",
-            ERROR
-        )
+        if name in self.labels:
+            self._fail(
+                f"Macro name '{name}' conflicts with an existing label.",
+                ERROR
+            )
 
         # Check that the value is valid and matches the name prefix
         if name.startswith("!"):
             # Raw macro, allow anything
-            return
+            return name_stripped
 
         # check for a comment or string (as those could break things)
-        self._log_assert(
-            not DETECT_COMMENT_OR_STR_RE.search(value),
-            f"Non-raw macro value '{value}' contains a string or comment.\n  "
-            "Comments in macros can break things by commenting out everything after them where " +
-            "they're used.\n  " +
-            "If you are trying to define a string you should use the ! prefix for a raw macro " +
-            "e.g. #define !STR_1 \"hello\".",
-            ERROR
-        )
-
-        if name.startswith("$"):
-            self._log_assert(
-                self.is_register(value),
-                f"Value '{value}' of register macro is not a valid register.",
+        if DETECT_COMMENT_OR_STR_RE.search(value):
+            self._fail(
+                f"Non-raw macro value '{value}' contains a string or comment.\n  "
+                "Comments in macros can break things by commenting out everything after them " +
+                "where they're used.\n  " +
+                "If you are trying to define a string you should use the ! prefix for a raw " +
+                "macro e.g. #define !STR_1 \"hello\".",
                 ERROR
             )
+
+        if name.startswith("$"):
+            if not self.is_register(value):
+                self._fail(
+                    f"Value '{value}' of register macro is not a valid register.",
+                    ERROR
+                )
         elif name.startswith("."):
-            self._log_assert(
-                value in reserved_word_lists["directives"],
-                f"Value '{value}' of directive macro is not a valid directive.",
-                ERROR
-            )
+            if value not in DIRECTIVES:
+                self._fail(
+                    f"Value '{value}' of directive macro is not a valid directive.",
+                    ERROR
+                )
         elif name.startswith("@"):
             # there are a bunch of possible address formats
             # BACKLOG: write a regex for them
             # in the meantime, just check that it's not a register or number
-            self._log_assert(
-                not value.startswith("$"),
-                f"Value '{value}' of address macro looks like a register, did you mean ({value})?",
-                ERROR
-            )
-            self._log_assert(
-                not NUMBER_RE.match(value),
-                f"Value '{value}' of address macro looks like a number, this probably isn't right.",
-                WARNING
-            )
+            if value.startswith("$"):
+                self._fail(
+                    f"Value '{value}' of address macro looks like a register, " +
+                    f"did you mean ({value})?",
+                    ERROR
+                )
+            if NUMBER_RE.match(value):
+                self._fail(
+                    f"Value '{value}' of address macro looks like a number, " +
+                    "this probably isn't right.",
+                    WARNING
+                )
         else:
-            self._log_assert(
-                IMMEDIATE_RE.match(value),
-                f"Immediate macro value '{value}' isn't a valid single immediate.\n  "
-                "If you are trying to define a compound mathematical expression you should use "
-                "mipsy's built-in syntax e.g. X = 1 + 2.\n  " +
-                "Because #defines use text substitution, compound immediate macros won't work " +
-                "everywhere you'd expect them to.\n  " +
-                "If you *really* know what you're doing you can use the ! prefix to perform a " +
-                "raw substitution with no sanity checking e.g. #define !X 1 + 2.",
-                ERROR
-            )
+            if not IMMEDIATE_RE.match(value):
+                self._fail(
+                    f"Immediate macro value '{value}' isn't a valid single immediate.\n  "
+                    "If you are trying to define a compound mathematical expression you should " +
+                    "use mipsy's built-in syntax e.g. X = 1 + 2.\n  " +
+                    "Because #defines use text substitution, compound immediate macros won't " +
+                    "work everywhere you'd expect them to.\n  " +
+                    "If you *really* know what you're doing you can use the ! prefix to perform " +
+                    "a raw substitution with no sanity checking e.g. #define !X 1 + 2.",
+                    ERROR
+                )
 
+        return name_stripped
 
-    def parse_macro(self, comment: str):
+
+    def parse_macro(self, comment: str) -> None:
         if comment.startswith("#define "):
             try:
                 _, name, val = comment.split(maxsplit=2)
@@ -267,10 +279,10 @@ class Preprocessor:
                 self.logger.error(msg)
                 raise PreprocessingException(msg)
             
-            self.check_macro(name, val.strip())
+            name_stripped = self.check_macro(name, val.strip())
             # print(f"{name=}, {val=}")
             self.macros[name] = val
-            self.macros_stripped[self.strip_name(name)].append(name)
+            self.macros_stripped[name_stripped].append(name)
         elif comment.startswith("#defineuntil "):
             try:
                 _, label, name, val = comment.split(maxsplit=3)
@@ -280,129 +292,96 @@ class Preprocessor:
                 self.logger.error(msg)
                 raise PreprocessingException(msg)
             # make sure the label is valid
-            self._log_assert(
-                LABEL_RE.match(label),
-                f"Scoped macro label '{label}' is not a valid label name. Make sure you're not " +
-                "including the ':' used only in the label definition.",
-                ERROR
-            )
+            if not LABEL_RE.match(label):
+                self._fail(
+                    f"Scoped macro label '{label}' is not a valid label name. Make sure you're " +
+                    "not including the ':' used only in the label definition.",
+                    ERROR
+                )
             # make sure we're not already past the label
-            self._log_assert(
-                label not in self.labels,
-                f"Scoped macro '{comment}' is defined after its finishing label '{label}'.",
-                ERROR
-            )
-            self.check_macro(name, val.strip())
+            if label in self.labels:
+                self._fail(
+                    f"Scoped macro '{comment}' is defined after its finishing label '{label}'.",
+                    ERROR
+                )
+            name_stripped = self.check_macro(name, val.strip())
             # print(f"{label=}, {name=}, {val=}")
             self.macros[name] = val
-            self.macros_stripped[self.strip_name(name)].append(name)
-            self.label_watches[label].append(name)
-
-
-    # token_end is the index of the first character after the token
-    # i.e. the first character that didn't match.
-    def _finish_token(self, token_end: int):
-        token = self.program[self.token_start:token_end]
-        if TOKEN_RE.match(token):
-            # attempt to parse a label
-            if token.endswith(":"):
-                label = token[:-1]
-                self._log_assert(
-                    label not in self.macros,
+            self.macros_stripped[name_stripped].append(name)
+            self.label_watches.setdefault(label, []).append(name)
+
+
+    # Handles a token that might be substituted (or a label definition).
+    # token_end is the index of the first character after the token.
+    def _finish_token(self, token: str, token_start: int, token_end: int) -> None:
+        # attempt to parse a label
+        if token.endswith(":"):
+            label = token[:-1]
+            if label in self.macros:
+                self._fail(
                     f"Label name '{label}' conflicts with an existing macro.",
                     ERROR
                 )
-                self.labels.append(label)
-
-                # undefine any #defineuntil <this label>
-                for macro_name in self.label_watches[label]:
-                    del self.macros[macro_name]
-                    macro_name_stripped = self.strip_name(macro_name)
-                    macro_name_stripped_matches = self.macros_stripped[macro_name_stripped]
-                    macro_name_stripped_matches.remove(macro_name)
-                    if not macro_name_stripped_matches:
-                        del self.macros_stripped[macro_name_stripped]      
-                del self.label_watches[label]
-            
-            # get the macro value for the token if one exists
-            replacement = self.macros[token] if token in self.macros else token
-            self.tokens.append((token, (self.token_start, token_end), replacement))
+            self.labels.append(label)
+
+            # undefine any #defineuntil <this label>
+            for macro_name in self.label_watches.pop(label, ()):
+                del self.macros[macro_name]
+                macro_name_stripped = self.strip_name(macro_name)
+                macro_name_stripped_matches = self.macros_stripped[macro_name_stripped]
+                macro_name_stripped_matches.remove(macro_name)
+                if not macro_name_stripped_matches:
+                    del self.macros_stripped[macro_name_stripped]      
+        
+        # get the macro value for the token if one exists
+        replacement = self.macros.get(token, token)
 
-            # replace the token in the output code
-            self.new_program += self.program[self.new_program_up_to:self.token_start]
-            self.new_program += replacement
-            self.new_program_up_to = token_end
-        self.token_start = token_end
+        # replace the token in the output code
+        self._out_parts.append(self.program[self.new_program_up_to:token_start])
+        self._out_parts.append(replacement)
+        self.new_program_up_to = token_end
 
 
     # Tokenise and replace in a single pass.
-    def process(self, program: str):
+    def process(self, program: str) -> str:
         # Initialise attrs
         self.program = program
-        self.new_program = ""
+        self._out_parts = []  # joined into self.new_program at the end
         self.new_program_up_to = 0
         self.macros = {}
         self.macros_stripped = defaultdict(list)
-        self.label_watches = defaultdict(list)
-        self.tokens = []
+        self.label_watches = {}  # label --> names of the #defineuntil macros it ends
         self.labels = []
-        self.token_start = 0
-        self.line_no = 1
+        # line numbers are only needed when logging, so just record where the newlines are
+        self._newlines = [match.start() for match in re.finditer("\n", program)]
+        self._pos = 0  # the position in the program that processing is at
         
-        # Uses a state machine to ignore comments, strings, and chars.
-        state = State.CODE
-        for i, c in enumerate(self.program): 
-            if state == State.CODE:
-                if not PSEUDO_TOKEN_RE.match(self.program[self.token_start:i + 1]):
-                    self._finish_token(i)
-
-                if c == '"':
-                    state = State.STRING
-                elif c == "#":
-                    # attempt to parse a #define
-                    comment = self.program[i:].split("\n")[0]
-                    self.parse_macro(comment)
-
-                    state = State.COMMENT
-                elif c == "'":
-                    state = State.CHAR
-            elif state == State.STRING:
-                if c == '"':
-                    state = State.CODE
-                elif c == "\\":
-                    state = State.STRING_ESC
-            elif state == State.STRING_ESC:
-                # consume a character
-                state = State.STRING
-            elif state == State.CHAR:
-                if c == "\\":
-                    state = State.CHAR_2
-                else:
-                    state = State.CHAR_END
-            elif state == State.CHAR_2:
-                # consume a character
-                state = State.CHAR_END
-            elif state == State.CHAR_END:
-                state = State.CODE
-                if c != "'":
-                    self.logger.warning(
-                        f"Expected closing single quote, got {repr(c)}. " +
-                        "Ignoring the rest of the line."
-                    )
-                    # Treat as a comment and skip until the next newline
-                    state = State.COMMENT if c != "\n" else State.CODE
-
-            elif state == State.COMMENT:
-                if c == "\n":
-                    state = State.CODE
-            
-            if c == "\n":
-                self.line_no += 1
+        # bound once here since they're used for every match in the loop below
+        finish_token = self._finish_token
+        parse_macro = self.parse_macro
+
+        # The scanner skips over strings, chars, and comments so we only look at code.
+        for match in SCANNER_RE.finditer(program):
+            kind = match.lastgroup
+            if kind == "tok":
+                self._pos = pos = match.start()
+                finish_token(match.group(), pos, match.end())
+            elif kind == "cmt":
+                # attempt to parse a #define
+                self._pos = match.start()
+                parse_macro(match.group())
+            elif kind == "chr" and match.start("badchr") != -1:
+                # the rest of the line is treated as a comment and skipped
+                self._pos = match.start("badchr")
+                self.logger.warning(
+                    f"Expected closing single quote, got {repr(program[self._pos])}. " +
+                    "Ignoring the rest of the line."
+                )
 
-        if self.token_start < len(self.program):
-            self._finish_token(len(self.program))
-        if self.new_program_up_to < len(self.program):
-            self.new_program += self.program[self.new_program_up_to:len(self.program)]
+        self._out_parts.append(program[self.new_program_up_to:])
+        self.new_program = "".join(self._out_parts)
+        self._out_parts = []  # don't hold on to a second copy of the output
+        self._pos = len(program)
         
         # make sure all the #defineuntils are done
         for label, macros in self.label_watches.items():